@@ -9,12 +9,25 @@ from dotenv import load_dotenv
 import os
 import sys
 import time
-import json
+import gzip
+import hashlib
+import pickle
+import queue
+import tempfile
+import threading
 import argparse
+import bisect
+import functools
+import heapq
+import math
 import logging
 from pathlib import Path
+from typing import NamedTuple, Optional
 from plexapi.server import PlexServer
-from rapidfuzz import fuzz
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from rapidfuzz import fuzz, process
 
 # ---- Configuration ----
 load_dotenv()  # loads .env from current directory
@@ -24,8 +37,11 @@ PLEX_TOKEN = os.environ.get("PLEX_TOKEN")
 if not PLEX_TOKEN:
     sys.exit("PLEX_TOKEN not set. Put it in .env or export it in your environment.")
 
-CACHE_FILE = Path.home() / ".plex_cache.json"
+CACHE_FILE = Path.home() / ".plex_cache.pkl.gz"
+CACHE_HASH_FILE = Path.home() / ".plex_cache.hash"
+CACHE_VERSION = 4  # bump when the cached item layout changes
 CACHE_TTL = 60 * 60 * 6  # 6 hours
+FETCH_WORKERS = 8  # sections fetched in parallel during a cache refresh
 LOG_LEVEL = os.environ.get("PLEX_CHECK_LOG", "INFO").upper()
 
 # ---- Logging ----
@@ -33,8 +49,15 @@ logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s: %(messag
 log = logging.getLogger("plex_check")
 
 # ---- Connect to Plex ----
+# One pooled keep-alive session for every request (parallel section fetches
+# included), so queries reuse open connections instead of re-handshaking.
+# requests already asks for gzip, which shrinks the large section listings.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.3))
+session.mount("http://", adapter)
+session.mount("https://", adapter)
 try:
-    plex = PlexServer(PLEX_BASE, PLEX_TOKEN)
+    plex = PlexServer(PLEX_BASE, PLEX_TOKEN, session=session)
 except Exception as e:
     log.error("Failed to connect to Plex at %s: %s", PLEX_BASE, e)
     sys.exit(1)
@@ -44,137 +67,374 @@ def load_cache():
     if not CACHE_FILE.exists():
         return {"updated": 0, "libraries": {}}
     try:
-        return json.loads(CACHE_FILE.read_text(encoding="utf-8"))
+        with gzip.open(CACHE_FILE, "rb") as f:
+            cache = pickle.load(f)
     except Exception as e:
         log.warning("Failed to read cache file: %s. Recreating cache.", e)
         return {"updated": 0, "libraries": {}}
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        log.info("Cache file is from an older version. Recreating cache.")
+        return {"updated": 0, "libraries": {}}
+    # the file's mtime is the last refresh time (see save_cache)
+    cache["updated"] = CACHE_FILE.stat().st_mtime
+    return cache
 
+# The refresh time is kept as the file's mtime rather than inside the pickle,
+# so an unchanged library serializes to identical bytes. Those are hashed and
+# only written when the hash differs; otherwise the file is just touched.
+# Writes go to a temp file and are moved into place, so an interrupted write
+# never leaves a truncated cache behind.
 def save_cache(cache):
     try:
-        CACHE_FILE.write_text(json.dumps(cache), encoding="utf-8")
+        data = pickle.dumps({"version": CACHE_VERSION, "libraries": cache["libraries"]}, protocol=5)
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if (CACHE_FILE.exists() and CACHE_HASH_FILE.exists()
+                and CACHE_HASH_FILE.read_text(encoding="utf-8") == digest):
+            os.utime(CACHE_FILE)
+            return
+        # a unique temp file per write, so concurrent saves never share one
+        with tempfile.NamedTemporaryFile(dir=CACHE_FILE.parent, prefix=CACHE_FILE.name + ".",
+                                         suffix=".tmp", delete=False) as tmp:
+            try:
+                # level 1: about half the compression time of the default 9 for a
+                # few percent more bytes; decompression speed is the same either way
+                with gzip.GzipFile(fileobj=tmp, mode="wb", compresslevel=1) as f:
+                    f.write(data)
+            except Exception:
+                tmp.close()
+                os.unlink(tmp.name)
+                raise
+        os.replace(tmp.name, CACHE_FILE)
+        CACHE_HASH_FILE.write_text(digest, encoding="utf-8")
     except Exception as e:
         log.warning("Failed to write cache file: %s", e)
 
-def refresh_cache(force=False):
-    cache = load_cache()
+# Items are stored column-wise (one list per field, same index = same item) so
+# search_fuzzy can hand the title_sorted column straight to rapidfuzz and only
+# touch the other columns for the handful of rows that pass the cutoff.
+ITEM_FIELDS = ("title", "title_norm", "title_sorted", "year", "type", "ratingKey")
+
+# The one place titles are normalized. Cached titles go through these once at
+# refresh time and are stored in both forms; queries go through them once per
+# search, so nothing is re-normalized per comparison.
+def normalize_title(title):
+    return title.strip().lower() if title else ""
+
+def sort_tokens(title_norm):
+    return " ".join(sorted(title_norm.split()))
+
+def new_columns():
+    return {field: [] for field in ITEM_FIELDS}
+
+# Sections as listed by the server right now. plexapi caches
+# plex.library.sections() for the life of the process, so refreshes query the
+# listing directly to pick up sections added or removed on the server.
+class LibrarySection(NamedTuple):
+    key: str
+    title: Optional[str]
+    type: Optional[str]
+
+def _list_sections():
+    return [LibrarySection(e.get("key"), e.get("title"), e.get("type"))
+            for e in plex.query("/library/sections") if e.get("key")]
+
+def _load_section(section):
+    items = new_columns()
+    # One request for the raw section listing instead of section.all(), which
+    # pages through the library and builds a full PlexObject per item. Only the
+    # attributes we cache are read off the XML elements.
+    root = plex.query(f"/library/sections/{section.key}/all")
+    for e in (root if root is not None else ()):
+        title = e.get("title")
+        if not title or not e.get("ratingKey"):
+            continue
+        title_norm = normalize_title(title)
+        year = e.get("year")
+        items["title"].append(title)
+        items["title_norm"].append(title_norm)
+        items["title_sorted"].append(sort_tokens(title_norm))
+        items["year"].append(int(year) if year else None)
+        items["type"].append(e.get("type"))
+        items["ratingKey"].append(int(e.get("ratingKey")))
+    return str(section.key), {
+        "title": section.title,
+        "type": section.type,
+        "items": items
+    }
+
+# Yields (key, lib) for each section as soon as its listing arrives. Each
+# listing blocks on HTTP, so all sections are fetched at once and the whole
+# refresh takes about as long as the slowest section. The fetchers are plain
+# daemon threads rather than a ThreadPoolExecutor, whose workers are joined at
+# interpreter exit and would keep a user who quits early waiting on downloads.
+def refresh_cache_stream(sections):
+    pending = queue.Queue()
+    for section in sections:
+        pending.put(section)
+    done = queue.Queue()
+
+    def fetch():
+        while True:
+            try:
+                section = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put((section, _load_section(section), None))
+            except Exception as e:
+                done.put((section, None, e))
+
+    for _ in range(min(FETCH_WORKERS, len(sections))):
+        threading.Thread(target=fetch, daemon=True).start()
+    for _ in range(len(sections)):
+        section, result, error = done.get()
+        if error is not None:
+            log.warning("Failed to read section %s: %s", getattr(section, "title", section.key), error)
+            continue
+        yield result
+
+# Loaded libraries keyed in the server's section order, regardless of which
+# fetch finished first; sections that failed to load are left out.
+def _in_server_order(sections, loaded):
+    return {str(s.key): loaded[str(s.key)] for s in sections if str(s.key) in loaded}
+
+# Background half of refresh_cache(background=True): publishes each section
+# into the live cache as it arrives, then saves once everything is in.
+def _fill_cache(cache, sections):
+    ready = cache["ready"]
+    try:
+        for key, lib in refresh_cache_stream(sections):
+            with ready:
+                cache["libraries"][key] = lib
+                ready.notify_all()
+    finally:
+        with ready:
+            cache["libraries"] = _in_server_order(sections, cache["libraries"])
+            cache["complete"] = True
+            ready.notify_all()
+    save_cache(cache)
+
+# Blocks a search until the sections it reads are in the cache. Caches loaded
+# from disk or refreshed in the foreground are always complete.
+def wait_for_sections(cache, section_id=None):
+    ready = cache.get("ready")
+    if ready is None:
+        return
+    with ready:
+        ready.wait_for(lambda: cache["complete"]
+                       or (section_id is not None and str(section_id) in cache["libraries"]))
+
+# With background=True the section listings are fetched on a worker thread and
+# the cache is returned right away; searches wait only for what they need, so
+# the fetch overlaps with the user typing the first query.
+#
+# Pass the in-memory `cache` to refresh it without re-reading the file. If Plex
+# can't be reached, the existing cache is kept and its timestamp bumped, so the
+# next attempt waits another ttl instead of retrying on every query.
+def refresh_cache(force=False, background=False, ttl=CACHE_TTL, cache=None):
+    if cache is None:
+        cache = load_cache()
     now = time.time()
-    if not force and (now - cache.get("updated", 0) < CACHE_TTL):
+    if not force and (now - cache.get("updated", 0) < ttl):
         return cache
     log.info("Refreshing library cache from Plex...")
-    libraries = {}
     try:
-        sections = plex.library.sections()
+        sections = _list_sections()
     except Exception as e:
-        log.error("Failed to list library sections: %s", e)
+        log.error("Failed to list library sections: %s. Keeping the current cache.", e)
+        cache["updated"] = now
         return cache
-    for section in sections:
-        try:
-            items = []
-            # iterate section.all() can be slow for very large libraries; this is cached
-            for item in section.all():
-                items.append({
-                    "title": getattr(item, "title", None),
-                    "year": getattr(item, "year", None),
-                    "type": getattr(item, "type", None),
-                    "ratingKey": getattr(item, "ratingKey", None)
-                })
-            libraries[str(section.key)] = {
-                "title": section.title,
-                "type": section.type,
-                "items": items
-            }
-        except Exception as e:
-            log.warning("Failed to read section %s: %s", getattr(section, "title", section.key), e)
-            continue
+    if background:
+        cache = {"updated": now, "libraries": {}, "complete": False, "ready": threading.Condition()}
+        # Daemon thread: exiting before the listings finish downloading must not
+        # hang the process, so an early exit skips this save and the next run
+        # refreshes again. save_cache replaces the file atomically, so being
+        # cut off mid-save leaves the previous cache intact.
+        threading.Thread(target=_fill_cache, args=(cache, sections),
+                         name="plex-cache-refresh", daemon=True).start()
+        return cache
+    libraries = _in_server_order(sections, dict(refresh_cache_stream(sections)))
     cache = {"updated": now, "libraries": libraries}
     save_cache(cache)
     return cache
 
 # ---- Search helpers ----
-def search_exact(title, section_id=None):
-    title_norm = title.strip().lower()
+# One search hit. A NamedTuple is a fraction of the size of the equivalent
+# dict and immutable, so memoized results can be handed out without copying.
+class Match(NamedTuple):
+    title: str
+    year: Optional[int]
+    type: Optional[str]
+    ratingKey: Optional[int]
+    library: Optional[str] = None
+    score: Optional[float] = None
+
+def _exact_matches(title, results):
+    title_norm = normalize_title(title)
+    matches = []
+    for r in results:
+        if normalize_title(getattr(r, "title", None)) == title_norm:
+            matches.append(Match(
+                title=r.title,
+                year=getattr(r, "year", None),
+                type=getattr(r, "type", None),
+                ratingKey=getattr(r, "ratingKey", None),
+                library=getattr(r, "librarySectionTitle", None)
+            ))
+    return tuple(matches)
+
+# Repeated queries in the interactive loop are answered from memory. Exact
+# results are memoized per (title, section, cache generation), so a cache
+# refresh also lets exact search see titles added to Plex since. Failed
+# lookups raise inside the memoized function so they are not cached.
+@functools.lru_cache(maxsize=512)
+def _search_exact_impl(title, section_id, generation):
+    if section_id is not None:
+        results = plex.library.sectionByID(section_id).search(title)
+    else:
+        results = plex.search(title, mediatype="movie")
+    return _exact_matches(title, results)
+
+def search_exact(title, section_id=None, cache=None):
+    generation = cache["updated"] if cache is not None else None
     try:
-        if section_id is not None:
-            section = plex.library.sectionByID(section_id)
-            results = section.search(title)
-        else:
-            results = plex.search(title, mediatype="movie")
+        return list(_search_exact_impl(title, section_id, generation))
     except Exception:
-        # fallback to server-wide search if section lookup fails
+        # fallback to server-wide search if section lookup fails; not memoized,
+        # so the scoped search is retried on the next query
         try:
-            results = plex.search(title)
+            return list(_exact_matches(title, plex.search(title)))
         except Exception as e:
             log.error("Search failed: %s", e)
             return []
-    matches = []
-    for r in results:
-        if getattr(r, "title", "").strip().lower() == title_norm:
-            matches.append({
-                "title": r.title,
-                "year": getattr(r, "year", None),
-                "type": getattr(r, "type", None),
-                "ratingKey": getattr(r, "ratingKey", None),
-                "library": getattr(r, "librarySectionTitle", None)
-            })
-    return matches
-
-def search_fuzzy(title, threshold=80, section_id=None, cache=None):
-    title_norm = title.strip().lower()
-    if cache is None:
-        cache = refresh_cache()
-    items = []
+
+# Columns for one section, or for every section concatenated when section_id
+# is None. The concatenated view is built once per cache generation and kept on
+# the cache dict rather than re-extended on every query.
+def _section_items(cache, section_id):
     if section_id is not None:
         lib = cache["libraries"].get(str(section_id))
-        if lib:
-            items = lib["items"]
-    else:
+        return lib["items"] if lib else new_columns()
+    items = cache.get("flat_items")
+    if items is None:
+        items = new_columns()
         for lib in cache["libraries"].values():
-            items.extend(lib["items"])
+            for field in ITEM_FIELDS:
+                items[field].extend(lib["items"][field])
+        cache["flat_items"] = items
+    return items
+
+# fuzz.ratio is 100 * (1 - indel / (len_a + len_b)) and the indel distance is
+# at least |len_a - len_b|, so a title can only reach `threshold` if its length
+# lies in this window around the query's length. Callers keep threshold <= 100.
+def _length_window(q_len, threshold):
+    if threshold <= 0:
+        return 0, math.inf
+    lo = q_len * threshold / (200 - threshold)
+    hi = q_len * (200 - threshold) / threshold
+    return math.ceil(lo - 1e-9), math.floor(hi + 1e-9)
+
+# title_sorted reordered by length, with the original positions alongside,
+# built lazily per section and kept on the cache dict. Titles in a length
+# window are then one contiguous slice found with two bisections.
+def _length_band(cache, section_id, items, min_len, max_len):
+    indexes = cache.setdefault("length_index", {})
+    if section_id not in indexes:
+        titles = items["title_sorted"]
+        order = sorted(range(len(titles)), key=lambda idx: len(titles[idx]))
+        indexes[section_id] = ([len(titles[idx]) for idx in order], [titles[idx] for idx in order], order)
+    lengths, by_length, order = indexes[section_id]
+    lo = bisect.bisect_left(lengths, min_len)
+    hi = bisect.bisect_right(lengths, max_len)
+    return by_length[lo:hi], order[lo:hi]
+
+# Only the best `limit` matches are ever shown, so keep a bounded heap over the
+# rows that clear score_cutoff instead of sorting all of them. The scoring
+# itself already runs in rapidfuzz's compiled kernel and only rows above the
+# cutoff come back to Python, so there is no per-title Python loop left to JIT.
+# `positions` maps choice indexes in the scored slice back to library indexes;
+# ties are broken by library order.
+def _top_matches(q_sorted, choices, threshold, limit, positions):
+    scored = process.extract_iter(q_sorted, choices, scorer=fuzz.ratio,
+                                  processor=None, score_cutoff=threshold)
+    scored = ((choice, score, positions[idx]) for choice, score, idx in scored)
+    return heapq.nlargest(limit, scored, key=lambda r: (r[1], -r[2]))
+
+# Every title whose length can still reach the threshold is scored, so the
+# result is always the same as a full scan.
+def _search_fuzzy_impl(cache, q_sorted, threshold, section_id, limit):
+    # --threshold is not range-checked; rapidfuzz only accepts cutoffs in
+    # 0-100, and like a plain score >= threshold test, anything above 100
+    # matches nothing and anything below 0 matches everything
+    if threshold > 100:
+        return ()
+    threshold = max(threshold, 0)
+    items = _section_items(cache, section_id)
+    min_len, max_len = _length_window(len(q_sorted), threshold)
     found = []
-    for it in items:
-        if not it.get("title"):
-            continue
-        score = fuzz.token_sort_ratio(title_norm, it["title"].strip().lower())
-        if score >= threshold:
-            found.append({
-                "title": it["title"],
-                "year": it.get("year"),
-                "score": score,
-                "type": it.get("type"),
-                "ratingKey": it.get("ratingKey")
-            })
-    return sorted(found, key=lambda x: x["score"], reverse=True)
+    choices, positions = _length_band(cache, section_id, items, min_len, max_len)
+    results = _top_matches(q_sorted, choices, threshold, limit, positions)
+    for _, score, idx in results:
+        found.append(Match(
+            title=items["title"][idx],
+            year=items["year"][idx],
+            type=items["type"][idx],
+            ratingKey=items["ratingKey"][idx],
+            score=score
+        ))
+    return tuple(found)
+
+def search_fuzzy(title, threshold=80, section_id=None, cache=None, limit=20):
+    title_norm = normalize_title(title)
+    # token_sort_ratio == ratio on sorted tokens; sort the query once here and
+    # compare against titles that were sorted when the cache was built
+    q_sorted = sort_tokens(title_norm)
+    if cache is None:
+        cache = refresh_cache()
+    wait_for_sections(cache, section_id)
+    # Memoize per cache generation: every refresh produces a new cache dict, so
+    # the memo hangs off the dict itself and is dropped along with it.
+    memo = cache.get("fuzzy_memo")
+    if memo is None:
+        memo = cache["fuzzy_memo"] = functools.lru_cache(maxsize=512)(
+            functools.partial(_search_fuzzy_impl, cache))
+    return list(memo(q_sorted, threshold, section_id, limit))
 
 # ---- Output helper (safe printing for mixed object types) ----
+# Result lists are joined and written in one call rather than printed per row.
+def write_lines(lines):
+    sys.stdout.write("\n".join(lines) + "\n")
+
+def _format_server_result(r):
+    title_val = getattr(r, "title", None) or getattr(r, "name", None) or getattr(r, "tag", None) or "<unknown>"
+    rtype = getattr(r, "type", type(r).__name__)
+    year = getattr(r, "year", "n/a")
+    library = getattr(r, "librarySectionTitle", "n/a")
+    ratingKey = getattr(r, "ratingKey", "n/a")
+    return f"- {title_val} ({year}) — {rtype} — {library} — ratingKey {ratingKey}"
+
 def print_search_results_from_server(results, limit=20):
     if not results:
         print("No results from server search.")
         return
-    for r in results[:limit]:
-        title_val = getattr(r, "title", None) or getattr(r, "name", None) or getattr(r, "tag", None) or "<unknown>"
-        rtype = getattr(r, "type", type(r).__name__)
-        year = getattr(r, "year", "n/a")
-        library = getattr(r, "librarySectionTitle", "n/a")
-        ratingKey = getattr(r, "ratingKey", "n/a")
-        print(f"- {title_val} ({year}) — {rtype} — {library} — ratingKey {ratingKey}")
+    write_lines(_format_server_result(r) for r in results[:limit])
 
 # ---- Main search runner used by interactive loop and non-interactive mode ----
 def run_search(title, args, cache):
     # Exact first
-    exact = search_exact(title, section_id=args.section)
+    exact = search_exact(title, section_id=args.section, cache=cache)
     if exact:
-        print(f"\nExact match found ({len(exact)}):")
-        for m in exact:
-            print(f"- {m['title']} ({m['year']}) — {m['library']} — ratingKey {m['ratingKey']}")
+        write_lines([f"\nExact match found ({len(exact)}):"]
+                    + [f"- {m.title} ({m.year}) — {m.library} — ratingKey {m.ratingKey}" for m in exact])
         return
 
     # Fuzzy if requested
     if args.fuzzy:
         fuzzy_matches = search_fuzzy(title, threshold=args.threshold, section_id=args.section, cache=cache)
         if fuzzy_matches:
-            print(f"\nFuzzy matches (threshold {args.threshold}):")
-            for m in fuzzy_matches[:20]:
-                print(f"- {m['title']} ({m.get('year')}) — score {m['score']} — ratingKey {m['ratingKey']}")
+            write_lines([f"\nFuzzy matches (threshold {args.threshold}):"]
+                        + [f"- {m.title} ({m.year}) — score {m.score} — ratingKey {m.ratingKey}"
+                           for m in fuzzy_matches])
             return
         else:
             print("\nNo fuzzy matches found.")
@@ -198,13 +458,15 @@ def main():
     parser.add_argument("--refresh", action="store_true", help="Force refresh cache")
     parser.add_argument("--title", type=str, help="Title to search (non-interactive)", default=None)
     parser.add_argument("--loop", action="store_true", help="Keep prompting until exit/quit (interactive)")
+    parser.add_argument("--cache-ttl", type=int, default=CACHE_TTL, help="Seconds before the library cache is refreshed")
     args = parser.parse_args()
 
     if args.refresh:
         log.info("Forcing cache refresh...")
-        refresh_cache(force=True)
 
-    cache = refresh_cache()
+    # Load (or refresh) the cache once; interactive sessions refresh in the
+    # background while the user types
+    cache = refresh_cache(force=args.refresh, background=not args.title, ttl=args.cache_ttl)
 
     # Non-interactive mode: run once and exit
     if args.title:
@@ -212,6 +474,7 @@ def main():
         return
 
     # Interactive loop
+    pending = None  # TTL refresh still downloading, replaces `cache` when complete
     print("Type a movie/show name to search. Type 'exit' or 'quit' to stop.")
     try:
         while True:
@@ -221,8 +484,22 @@ def main():
             if q.lower() in ("exit", "quit"):
                 print("Goodbye.")
                 return
+            # The in-memory cache is reused across queries; only go back to
+            # Plex once it has outlived --cache-ttl, without re-reading disk.
+            # Searches keep using the current cache while the refresh downloads
+            # in the background, and the new one is swapped in once complete.
+            # A refresh still downloading is never restarted: its cache is
+            # stamped when it starts, so a short TTL would otherwise stack up
+            # a new refresh on every query.
+            if pending is not None and pending["complete"]:
+                cache, pending = pending, None
+            if (pending is None and cache.get("complete") is not False
+                    and time.time() - cache["updated"] > args.cache_ttl):
+                refreshed = refresh_cache(force=True, background=True, ttl=args.cache_ttl, cache=cache)
+                # if Plex can't be reached, refresh_cache hands back the current cache
+                if refreshed is not cache:
+                    pending = refreshed
             run_search(q, args, cache)
-            # Optionally refresh cache periodically if desired (not automatic here)
             if not args.loop:
                 # if --loop not provided, run once per invocation (but still allow exit)
                 print("\n(Use --loop to keep the program running continuously.)")